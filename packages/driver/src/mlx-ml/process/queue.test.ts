@@ -0,0 +1,40 @@
+import { describe, it, expect, vi } from 'vitest';
+import { Readable } from 'stream';
+import { QueueManager } from './queue.js';
+
+describe('MLX QueueManager', () => {
+  describe('request framing', () => {
+    it('should prefix the JSON payload with its UTF-8 byte length', () => {
+      const sendToProcess = vi.fn();
+      const queue = new QueueManager({
+        sendToProcess,
+        createNewStream: () => new Readable({ read() {} })
+      });
+
+      const messages = [{ role: 'user' as const, content: 'こんにちは、世界' }];
+      void queue.addFormatTestRequest(messages);
+
+      const json = JSON.stringify({ method: 'format_test', messages });
+      expect(sendToProcess).toHaveBeenCalledTimes(1);
+      expect(sendToProcess).toHaveBeenCalledWith(`${Buffer.byteLength(json)}\n${json}`);
+      // 文字数ではなくバイト長であること
+      expect(Buffer.byteLength(json)).not.toBe(json.length);
+    });
+
+    it('should frame streaming requests the same way', () => {
+      const sendToProcess = vi.fn();
+      const queue = new QueueManager({
+        sendToProcess,
+        createNewStream: () => new Readable({ read() {} })
+      });
+
+      void queue.addCompletionRequest('日本の首都は');
+
+      const [payload] = sendToProcess.mock.calls[0];
+      const newline = payload.indexOf('\n');
+      const json = payload.slice(newline + 1);
+      expect(Number(payload.slice(0, newline))).toBe(Buffer.byteLength(json));
+      expect(JSON.parse(json)).toMatchObject({ method: 'completion', prompt: '日本の首都は' });
+    });
+  });
+});
@@ -119,9 +119,9 @@ export class QueueManager {
       this.queue.shift(); // ここでshiftする
     }
 
-    // リクエストを送信
+    // リクエストを送信（`<JSONのバイト長>\n<JSON>` 形式）
     const input = JSON.stringify(request);
-    this.callbacks.sendToProcess(input + '\n');
+    this.callbacks.sendToProcess(`${Buffer.byteLength(input, 'utf8')}\n${input}`);
   }
 
   handleJsonResponse(jsonData: string): void {
@@ -1,8 +1,20 @@
+import os
 import sys
 import json
+import time
+import mlx.core as mx
 from mlx_lm import load, stream_generate
 from mlx_lm.sample_utils import make_sampler
-from token_utils import get_capabilities, is_eod_token
+from chat_template import detect_primer_appendable
+from token_utils import get_capabilities, get_end_token_ids, get_end_token_table, is_eod_token
+
+# デコーダーはリクエストごとに作らず使い回す
+_DECODER = json.JSONDecoder()
+
+
+def _loads(data):
+    return _DECODER.decode(data.decode('utf-8'))
+
 
 model_name = sys.argv[1] if len(sys.argv) > 1 else "mlx-community/gemma-3-270m-it-qat-4bit"
 
@@ -11,24 +23,184 @@ model, tokenizer = load(model_name)
 # Capabilities情報の取得
 capabilities = get_capabilities(tokenizer)
 
+# 終了トークンIDはtokenizerで決まるため、トークンごとに再構築せず起動時に一度だけ求める
+EOD_IDS = get_end_token_ids(tokenizer)
+EOD_TABLE = get_end_token_table(tokenizer, EOD_IDS)
+
+# primer付きプロンプトを生成プロンプト + primerで組み立てられるか（Falseなら分割処理にフォールバック）
+PRIMER_APPENDABLE = detect_primer_appendable(tokenizer)
+
+
+def warmup():
+    """
+    起動時にモデルをウォームアップする
+
+    MLXは重みの読み込みやカーネルのコンパイルを遅延実行するため、
+    1トークンだけ生成しておき、最初のリクエストのTTFTから除外する。
+    """
+    started = time.perf_counter()
+    try:
+        mx.eval(model.parameters())
+        prompt = [tokenizer.eos_token_id or 0]
+        for _ in stream_generate(model, tokenizer, prompt, max_tokens=1):
+            pass
+    except Exception as e:
+        sys.stderr.write(f"--- warmup failed: {e}\n")
+        return
+    sys.stderr.write(f"--- warmup: {time.perf_counter() - started:.3f}s\n")
+
+
+warmup()
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# ストリーミング出力をまとめて書き出す間隔（トークン数 / 秒）
+STREAM_FLUSH_TOKENS = 8
+STREAM_FLUSH_INTERVAL = 0.005
+
+_stdin = sys.stdin.buffer
+STDOUT_FD = sys.stdout.fileno()
+HAS_WRITEV = hasattr(os, 'writev')
+_pending = bytearray()
+
+
+def _fill():
+    """stdinから読み込めた分をバッファに追加する（EOFの場合False）"""
+    chunk = _stdin.read1(READ_CHUNK_SIZE)
+    if not chunk:
+        return False
+    _pending.extend(chunk)
+    return True
+
+
 def read():
-    lines = []
-    data = None
-    eof = False
-    while not eof:
-        line = sys.stdin.readline()
-        # sys.stderr.write('line:' + line + '\n')
-        if not line:
-            eof = True
-        else:
-            lines.append(line)
+    """
+    stdinから1リクエスト分のJSONを読み込む
+
+    TypeScript側は1リクエストを `<JSONのバイト長>\\n<JSON>` として送信する。
+    先頭が数字でない場合は、従来の `JSON + '\\n'` 形式として扱う。
+    次のリクエストの先頭まで読み込んだ場合は、その分を次回の呼び出しに持ち越す。
+
+    Returns:
+        dict | None: リクエスト（EOFの場合None）
+    """
+    # 前のリクエストの末尾の改行などを読み飛ばす
+    while True:
+        if _pending[:1].isspace():
+            del _pending[:len(_pending) - len(_pending.lstrip())]
+        if _pending:
+            break
+        if not _fill():
+            return None
+
+    if _pending[0] in b'0123456789':
+        return _read_framed()
+    return _read_delimited()
+
+
+def _read_framed():
+    """`<バイト長>\\n<JSON>` 形式のリクエストを読み込む"""
+    end = _pending.find(b'\n')
+    while end == -1:
+        start = len(_pending)
+        if not _fill():
+            return None
+        end = _pending.find(b'\n', start)
+
+    header = _pending[:end]
+    del _pending[:end + 1]
+    try:
+        length = int(header)
+    except ValueError:
+        sys.stderr.write(f"Error: invalid request header: {header!r}\n")
+        return {}
+
+    # 不足分は1回のreadでまとめて読み込む
+    missing = length - len(_pending)
+    if missing > 0:
+        _pending.extend(_stdin.read(missing))
+        if len(_pending) < length:
+            return None
+
+    data = _pending[:length]
+    del _pending[:length]
+    try:
+        return _loads(data)
+    except ValueError as e:
+        # 空のリクエストとして扱い、main側でエラー応答を返す
+        sys.stderr.write(f"Error: invalid request JSON: {e}\n")
+        return {}
+
+
+def _read_delimited():
+    """
+    `JSON + '\\n'` 形式のリクエストを読み込む
+
+    固定サイズのブロック単位で読み込み、改行が届いた時点でのみパースを試みるため、
+    巨大なプロンプトでもバッファ全体を行ごとに再パースすることはない。
+    """
+    start = 0
+    while True:
+        end = _pending.find(b'\n', start)
+        if end == -1:
+            start = len(_pending)
+            if not _fill():
+                # EOF: 改行で終わっていない残りを最後に試す
+                data = None
+                if _pending.strip():
+                    try:
+                        data = _loads(_pending)
+                    except json.JSONDecodeError:
+                        data = None
+                _pending.clear()
+                return data
+            continue
+
+        end += 1
         try:
-            data = json.loads(''.join(lines))
-        except json.JSONDecodeError as e:
-            data = None
+            data = _loads(_pending[:end])
+        except json.JSONDecodeError:
+            # JSONの途中の改行（整形済みJSONなど）なので続きを待つ
+            start = end
             continue
-        break
-    return data
+        del _pending[:end]
+        return data
+
+
+def _write_bytes(data):
+    """stdoutへバイト列を直接書き出す（部分書き込みの場合は残りを書き直す）"""
+    data = memoryview(data)
+    while data:
+        written = os.write(STDOUT_FD, data)
+        data = data[written:]
+
+
+def _write(text):
+    """
+    stdoutへUTF-8で直接書き出す
+
+    TextIOWrapperのバッファリングとロックを経由せず、os.writeで書き出す。
+    stdoutへの出力はすべてこの関数か_write_partsを通すこと（printと混在させると順序が崩れる）。
+    """
+    _write_bytes(text.encode('utf-8'))
+
+
+def _write_parts(parts):
+    """複数の文字列を連結せず、os.writevで1回の書き込みとして送る"""
+    buffers = [part.encode('utf-8') for part in parts]
+    if HAS_WRITEV:
+        written = os.writev(STDOUT_FD, buffers)
+        if written == sum(map(len, buffers)):
+            return
+        data = b''.join(buffers)[written:]
+    else:
+        data = b''.join(buffers)
+    _write_bytes(data)
+
+
+def _emit(text):
+    """レスポンスを終端のnull文字と合わせて1回の書き込みで送る"""
+    _write_parts((text, '\0'))
 
 
 def supports_chat_template():
@@ -46,9 +218,40 @@ def supports_chat_template():
             hasattr(tokenizer, 'chat_template') and 
             tokenizer.chat_template is not None)
 
+def _trim_after_last(text, sep):
+    """textの最後のsepより後ろを取り除く（sep自体は残す）"""
+    index = text.rfind(sep)
+    if index < 0:
+        return text
+    return text[:index + len(sep)]
+
+
+def format_chat_prompt(messages, primer=None):
+    """
+    チャットテンプレートを適用したプロンプトを生成する
+
+    primerがある場合は、assistantの発話がprimerの直後で途切れたプロンプトを返す。
+    """
+    if primer is None:
+        return tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+
+    if PRIMER_APPENDABLE:
+        # assistantの内容は生成プロンプトの直後に続くため、primerを連結するだけでよい
+        return tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False) + primer
+
+    # primerをassistantメッセージとして描画し、primerより後ろ（終了トークンなど）を取り除く
+    # （呼び出し元のmessagesは変更しない）
+    prompt = tokenizer.apply_chat_template(
+        messages + [{'role': 'assistant', 'content': primer}],
+        add_generation_prompt=False,
+        tokenize=False,
+    )
+    return _trim_after_last(prompt, primer)
+
+
 def handle_capabilities():
     """capabilities API の処理"""
-    print(json.dumps(capabilities), end='\0', flush=True)
+    _emit(json.dumps(capabilities))
 
 
 def handle_format_test(messages, options=None):
@@ -69,23 +272,9 @@ def handle_format_test(messages, options=None):
             # messagesはTypeScript側で既にモデル固有処理済み
             result["model_specific_processing"] = messages
             
-            # プロンプト生成（フォーマットのみ）
+            # プロンプト生成（フォーマットのみ、常にテキストで返す）
             primer = options.get('primer')
-            add_generation_prompt = True
-            tokenize = False  # 常にテキストで返す
-            
-            if primer is not None:
-                messages.append({'role': 'assistant', 'content': primer})
-                add_generation_prompt = False
-
-            formatted_prompt = tokenizer.apply_chat_template(
-                messages,
-                add_generation_prompt=add_generation_prompt,
-                tokenize=tokenize,
-            )
-
-            if primer is not None:
-                formatted_prompt = primer.join(formatted_prompt.split(primer)[0:-1]) + primer
+            formatted_prompt = format_chat_prompt(messages, primer)
             
             result["formatted_prompt"] = formatted_prompt
             result["template_applied"] = True
@@ -102,7 +291,7 @@ def handle_format_test(messages, options=None):
     except Exception as e:
         result["error"] = str(e)
     
-    print(json.dumps(result), end='\0', flush=True)
+    _emit(json.dumps(result))
 
 def handle_chat(messages, primer=None, options=None):
     """chat API の処理"""
@@ -118,32 +307,51 @@ def handle_chat(messages, primer=None, options=None):
         # primerはTypeScript側で既に追加されている場合があるので追加しない
         # （TypeScript側でcompletion APIへの変換時に追加済み）
         if primer is not None:
-            print(primer, end='', flush=True)
+            _write(primer)
         generate_text(prompt, options)
         return
     
     # messagesはTypeScript側で既にモデル固有処理済み
     
     # プロンプト生成
-    add_generation_prompt = True
-    tokenize = False
-    
+    prompt = format_chat_prompt(messages, primer)
+
     if primer is not None:
-        messages.append({'role': 'assistant', 'content': primer})
-        add_generation_prompt = False
-        tokenize = False
+        _write(primer)
 
-    prompt = tokenizer.apply_chat_template(
-        messages,
-        add_generation_prompt=add_generation_prompt,
-        tokenize=tokenize,
-    )
+    generate_text(encode_prompt(prompt), options)
 
-    if primer is not None:
-        prompt = primer.join(prompt.split(primer)[0:-1]) + primer
-        print(primer, end='', flush=True)
 
-    generate_text(prompt, options)
+HTML_COMMENT_BEGIN = '<!-- begin of {} -->'
+HTML_COMMENT_END = '<!-- end of {} -->'
+
+
+def _find_block_token(special_tokens):
+    """blockやcontextなどの汎用的なペアトークンを探す"""
+    for candidate in ['block', 'context', 'quote', 'section']:
+        token = special_tokens.get(candidate)
+        if token and isinstance(token, dict) and 'start' in token:
+            return token
+    return None
+
+
+def _role_wrapper(role, special_tokens, block_token):
+    """roleごとのメッセージ前後の文字列（head, tail）を返す"""
+    role_upper = role.upper()
+
+    # 1. 専用のspecial_tokenを探す
+    role_token = special_tokens.get(role)
+    if role_token and isinstance(role_token, dict) and 'start' in role_token:
+        # 専用トークンがある場合
+        return f"{role_token['start']['text']}\n", f"\n{role_token['end']['text']}"
+
+    # 2. 専用トークンがない場合、汎用blockトークンを使う
+    if block_token:
+        # 汎用blockトークンがある場合: {block_begin}{role}:\n...{block_end}
+        return f"{block_token['start']['text']}{role_upper}:\n", f"\n{block_token['end']['text']}"
+
+    # 3. どちらもない場合は、HTMLコメント形式（フォールバック）
+    return f"{HTML_COMMENT_BEGIN.format(role_upper)}\n", f"\n{HTML_COMMENT_END.format(role_upper)}"
 
 
 def generate_merged_prompt(messages):
@@ -151,56 +359,22 @@ def generate_merged_prompt(messages):
     # messagesはTypeScript側で既にmergeSystemMessages処理済み
     # TypeScript側のformatterと同じフォーマットを維持
 
-    prompt_parts = []
     special_tokens = capabilities.get('special_tokens', {})
+    block_token = _find_block_token(special_tokens)
 
+    # roleごとの前後の文字列は1回だけ組み立てる
+    wrappers = {}
+    blocks = []
     for msg in messages:
         role = msg['role']  # 小文字のまま
-        role_upper = role.upper()
-
-        # 1. 専用のspecial_tokenを探す
-        role_token = special_tokens.get(role)
-
-        if role_token and isinstance(role_token, dict) and 'start' in role_token:
-            # 専用トークンがある場合
-            start_token = role_token['start']['text']
-            end_token = role_token['end']['text']
-            prompt_parts.extend([
-                start_token,
-                msg['content'].strip(),
-                end_token,
-                ''  # 空行で区切る
-            ])
-        else:
-            # 2. 専用トークンがない場合、汎用blockトークンを探す
-            # blockやcontextなどの汎用的なペアトークンを探す
-            block_token = None
-            for candidate in ['block', 'context', 'quote', 'section']:
-                token = special_tokens.get(candidate)
-                if token and isinstance(token, dict) and 'start' in token:
-                    block_token = token
-                    break
-
-            if block_token:
-                # 汎用blockトークンがある場合: {block_begin}{role}:\n...{block_end}
-                start_token = block_token['start']['text']
-                end_token = block_token['end']['text']
-                prompt_parts.extend([
-                    f'{start_token}{role_upper}:\n{msg["content"].strip()}',
-                    end_token,
-                    ''  # 空行で区切る
-                ])
-            else:
-                # 3. どちらもない場合は、HTMLコメント形式（フォールバック）
-                prompt_parts.extend([
-                    f'<!-- begin of {role_upper} -->',
-                    msg['content'].strip(),
-                    f'<!-- end of {role_upper} -->',
-                    ''  # 空行で区切る
-                ])
+        wrapper = wrappers.get(role)
+        if wrapper is None:
+            wrapper = wrappers[role] = _role_wrapper(role, special_tokens, block_token)
+        head, tail = wrapper
+        blocks.append(head + msg['content'].strip() + tail)
 
-    # 最後の空行を削除して、ダブル改行で結合
-    return '\n'.join(prompt_parts[:-1])
+    # 空行で区切って結合
+    return '\n\n'.join(blocks)
 
 
 def handle_completion(prompt, options=None):
@@ -210,7 +384,19 @@ def handle_completion(prompt, options=None):
     
     # promptはTypeScript側で既にモデル固有処理済み
     
-    generate_text(prompt, options)
+    generate_text(encode_prompt(prompt), options)
+
+
+def encode_prompt(prompt):
+    """
+    プロンプトをトークンIDに変換する
+
+    stream_generateに文字列を渡した場合と同じく、
+    プロンプトがBOSトークンで始まっていない場合のみspecial tokensを付加する。
+    """
+    bos_token = tokenizer.bos_token
+    add_special_tokens = bos_token is None or not prompt.startswith(bos_token)
+    return tokenizer.encode(prompt, add_special_tokens=add_special_tokens)
 
 
 def generate_text(prompt, options):
@@ -239,18 +425,45 @@ def generate_text(prompt, options):
     else:
         sys.stderr.write(f"--- prompt\n{prompt}\n")
 
-    eos_detected = False
-    for response in stream_generate(model, tokenizer, prompt, **final_options):
-        # トークンIDによるEOS判定（より確実）
-        if is_eod_token(response, tokenizer):
-            eos_detected = True
-            print('\n', end='\0', flush=True)
-            break
-        if not eos_detected:
-            print(response.text.replace('\0', ''), end='', flush=True)
-    
-    if not eos_detected:
-        print('\n', end='\0', flush=True)
+    eod_table = EOD_TABLE
+    eod_table_size = len(eod_table)
+    write = _write_parts
+    pending = []
+    last_flush = time.perf_counter()
+    try:
+        for response in stream_generate(model, tokenizer, prompt, **final_options):
+            # トークンIDによるEOS判定（より確実）
+            token = getattr(response, 'token', None)
+            if token is None:
+                eod = is_eod_token(response, tokenizer)
+            else:
+                # テーブル外のID（tokenizerの語彙より大きい出力次元など）は終了トークンではない
+                eod = (token < eod_table_size and eod_table[token]) or response.finish_reason == 'stop'
+            if eod:
+                break
+
+            # トークンごとに書き出さず、一定数または一定時間ごとにまとめて書き出す
+            text = response.text
+            if '\0' in text:
+                # null文字はレスポンスの終端を表すため取り除く
+                text = text.replace('\0', '')
+            pending.append(text)
+            now = time.perf_counter()
+            if len(pending) >= STREAM_FLUSH_TOKENS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                write(pending)
+                pending.clear()
+                last_flush = now
+    except Exception:
+        # 生成途中で失敗した場合も、まとめていた分は捨てずに書き出してから送出する
+        # （終端はmain側のエラー応答で送る）
+        if pending:
+            write(pending)
+        raise
+
+    # 残りのテキストと終端をまとめて書き出す
+    pending.append('\n\0')
+    write(pending)
+
 
 def main():
     while True:
@@ -261,7 +474,7 @@ def main():
         method = req.get('method')
         if not method:
             sys.stderr.write("Error: 'method' field is required\n")
-            print('\n', end='\0', flush=True)
+            _emit('\n')
             continue
         
         try:
@@ -272,7 +485,7 @@ def main():
                 messages = req.get('messages')
                 if not messages:
                     sys.stderr.write("Error: 'messages' field is required for format_test method\n")
-                    print('\n', end='\0', flush=True)
+                    _emit('\n')
                     continue
                 
                 options = req.get('options', {})
@@ -282,7 +495,7 @@ def main():
                 messages = req.get('messages')
                 if not messages:
                     sys.stderr.write("Error: 'messages' field is required for chat method\n")
-                    print('\n', end='\0', flush=True)
+                    _emit('\n')
                     continue
                 
                 primer = req.get('primer')
@@ -293,7 +506,7 @@ def main():
                 prompt = req.get('prompt')
                 if not prompt:
                     sys.stderr.write("Error: 'prompt' field is required for completion method\n")
-                    print('\n', end='\0', flush=True)
+                    _emit('\n')
                     continue
                 
                 options = req.get('options', {})
@@ -301,11 +514,11 @@ def main():
             
             else:
                 sys.stderr.write(f"Error: Unknown method '{method}'\n")
-                print('\n', end='\0', flush=True)
+                _emit('\n')
         
         except Exception as e:
             sys.stderr.write(f"Error processing request: {e}\n")
-            print('\n', end='\0', flush=True)
+            _emit('\n')
 
 
 if __name__ == "__main__":
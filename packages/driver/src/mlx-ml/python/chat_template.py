@@ -0,0 +1,35 @@
+"""
+チャットテンプレートの検査
+
+tokenizerのチャットテンプレートの構造を起動時に調べ、
+プロンプトの組み立て方を決めるために使う。
+"""
+
+
+_PRIMER_PROBE = '<<primer>>'
+
+
+def detect_primer_appendable(tokenizer):
+    """
+    primerを生成プロンプトの後ろに連結するだけでよいかを判定する
+
+    生成プロンプト付きで描画した結果の直後にassistantの内容が続く形のテンプレートであれば、
+    primer付きのプロンプトは生成プロンプト + primerと一致する。
+
+    Args:
+        tokenizer: tokenizerオブジェクト
+
+    Returns:
+        bool: 生成プロンプトの後ろにprimerを連結できる場合True（判定できない場合False）
+    """
+    user_message = {'role': 'user', 'content': 'Hello'}
+    assistant_message = {'role': 'assistant', 'content': _PRIMER_PROBE}
+    try:
+        generation = tokenizer.apply_chat_template(
+            [user_message], add_generation_prompt=True, tokenize=False)
+        with_assistant = tokenizer.apply_chat_template(
+            [user_message, assistant_message], add_generation_prompt=False, tokenize=False)
+    except Exception:
+        return False
+
+    return with_assistant.startswith(generation + _PRIMER_PROBE)
@@ -4,6 +4,8 @@
 tokenizerのapply_chat_templateを使用して、
 モデルがサポートするメッセージパターンの制約を検出する。
 """
+# 検出結果はテンプレート文字列だけで決まるため、テンプレートごとにキャッシュする
+_RESTRICTIONS_CACHE: dict = {}
 
 
 def detect_chat_restrictions(tokenizer) -> dict:
@@ -26,6 +28,10 @@ def detect_chat_restrictions(tokenizer) -> dict:
     if not hasattr(tokenizer, 'apply_chat_template'):
         return None
 
+    template_string = getattr(tokenizer, 'chat_template', None)
+    if isinstance(template_string, str) and template_string in _RESTRICTIONS_CACHE:
+        return _RESTRICTIONS_CACHE[template_string]
+
     # テストパターンを実行
     test_results = {}
     for pattern in _get_test_patterns():
@@ -40,85 +46,87 @@ def detect_chat_restrictions(tokenizer) -> dict:
             test_results[pattern['name']] = {'error': str(e)}
 
     # テスト結果から制約を推論
-    return _infer_restrictions_from_results(test_results)
+    restrictions = _infer_restrictions_from_results(test_results)
+    if isinstance(template_string, str):
+        _RESTRICTIONS_CACHE[template_string] = restrictions
+    return restrictions
+
+
+def _pattern(name, *messages):
+    """
+    テストパターンを定義する
+
+    チャットテンプレートはmessagesをlist[dict]として扱う（tojsonフィルタなど）ため、
+    通常のdict/listで構築する。テンプレートの描画はサンドボックス内で行われ、
+    渡したメッセージが変更されることはない。
+    """
+    return {'name': name, 'messages': list(messages)}
+
+
+# テストパターンの定義（定数のためモジュール読み込み時に一度だけ構築する）
+_TEST_PATTERNS = (
+    # 基本パターン
+    _pattern(
+        'basic',
+        {'role': 'user', 'content': 'Hello'}
+    ),
+
+    # システムメッセージ付き
+    _pattern(
+        'with-system',
+        {'role': 'system', 'content': 'You are a helpful assistant.'},
+        {'role': 'user', 'content': 'Hello'}
+    ),
+
+    # 複数システムメッセージ
+    _pattern(
+        'multi-system',
+        {'role': 'system', 'content': 'First system message.'},
+        {'role': 'system', 'content': 'Second system message.'},
+        {'role': 'user', 'content': 'Hello'}
+    ),
+
+    # 連続ユーザーメッセージ
+    _pattern(
+        'consecutive-user',
+        {'role': 'user', 'content': 'First question'},
+        {'role': 'user', 'content': 'Second question'}
+    ),
+
+    # アシスタントで終わる
+    _pattern(
+        'assistant-last',
+        {'role': 'user', 'content': 'Hello'},
+        {'role': 'assistant', 'content': 'Hi there!'}
+    ),
+
+    # 交互の会話
+    _pattern(
+        'alternating',
+        {'role': 'user', 'content': 'Question 1'},
+        {'role': 'assistant', 'content': 'Answer 1'},
+        {'role': 'user', 'content': 'Question 2'}
+    ),
+
+    # 空メッセージ
+    _pattern(
+        'empty-message',
+        {'role': 'user', 'content': ''}
+    ),
+
+    # システムメッセージが途中にある
+    _pattern(
+        'system-middle',
+        {'role': 'user', 'content': 'First'},
+        {'role': 'system', 'content': 'System in middle'},
+        {'role': 'user', 'content': 'Second'}
+    ),
+)
 
 
 def _get_test_patterns():
     """テストパターンの定義"""
-    return [
-        # 基本パターン
-        {
-            'name': 'basic',
-            'messages': [
-                {'role': 'user', 'content': 'Hello'}
-            ]
-        },
-
-        # システムメッセージ付き
-        {
-            'name': 'with-system',
-            'messages': [
-                {'role': 'system', 'content': 'You are a helpful assistant.'},
-                {'role': 'user', 'content': 'Hello'}
-            ]
-        },
-
-        # 複数システムメッセージ
-        {
-            'name': 'multi-system',
-            'messages': [
-                {'role': 'system', 'content': 'First system message.'},
-                {'role': 'system', 'content': 'Second system message.'},
-                {'role': 'user', 'content': 'Hello'}
-            ]
-        },
-
-        # 連続ユーザーメッセージ
-        {
-            'name': 'consecutive-user',
-            'messages': [
-                {'role': 'user', 'content': 'First question'},
-                {'role': 'user', 'content': 'Second question'}
-            ]
-        },
-
-        # アシスタントで終わる
-        {
-            'name': 'assistant-last',
-            'messages': [
-                {'role': 'user', 'content': 'Hello'},
-                {'role': 'assistant', 'content': 'Hi there!'}
-            ]
-        },
-
-        # 交互の会話
-        {
-            'name': 'alternating',
-            'messages': [
-                {'role': 'user', 'content': 'Question 1'},
-                {'role': 'assistant', 'content': 'Answer 1'},
-                {'role': 'user', 'content': 'Question 2'}
-            ]
-        },
-
-        # 空メッセージ
-        {
-            'name': 'empty-message',
-            'messages': [
-                {'role': 'user', 'content': ''}
-            ]
-        },
-
-        # システムメッセージが途中にある
-        {
-            'name': 'system-middle',
-            'messages': [
-                {'role': 'user', 'content': 'First'},
-                {'role': 'system', 'content': 'System in middle'},
-                {'role': 'user', 'content': 'Second'}
-            ]
-        }
-    ]
+    return _TEST_PATTERNS
 
 
 def _infer_restrictions_from_results(test_results: dict) -> dict:
@@ -2,10 +2,170 @@
 トークン関連のユーティリティ関数
 """
 import sys
+from types import MappingProxyType
+from weakref import WeakKeyDictionary
 from chat_template_constraints import detect_chat_restrictions
 
+# tokenizerごとの終了トークンID（is_eod_tokenはトークンごとに呼ばれるため再構築しない）
+_END_ID_CACHE: "WeakKeyDictionary[object, frozenset]" = WeakKeyDictionary()
 
-def is_eod_token(response, tokenizer):
+# special_tokens_mapのキーのうち、終了トークンとして扱うもの（EOS以外）
+_END_RELATED_KEYS = ('eoi_token',)  # end_of_image
+
+# 会話終了トークン（added_tokens_encoderから直接取得する）
+_CONVERSATION_END_TOKENS = ('<end_of_turn>',)
+
+# ペアトークン（存在する場合のみ）
+_PAIR_TOKENS = MappingProxyType({
+    # ChatML基本形式
+    "system": ("<|system|>", "<|/system|>"),
+    "user": ("<|user|>", "<|/user|>"),
+    "assistant": ("<|assistant|>", "<|/assistant|>"),
+
+    # フォーマット・構造化
+    "code": ("<|code_start|>", "<|code_end|>"),
+    "python": ("<|python|>", "<|/python|>"),
+    "javascript": ("<|javascript|>", "<|/javascript|>"),
+    "bash": ("<|bash|>", "<|/bash|>"),
+    "quote": ("<|quote|>", "<|/quote|>"),
+    "ref": ("<|ref|>", "<|/ref|>"),
+    "citation": ("<|citation|>", "<|/citation|>"),
+    "table": ("<|table|>", "<|/table|>"),
+    "heading": ("<|heading|>", "<|/heading|>"),
+
+    # メディア・リッチコンテンツ
+    "image": ("<|image|>", "<|/image|>"),
+    "audio": ("<|audio|>", "<|/audio|>"),
+    "video": ("<|video|>", "<|/video|>"),
+
+    # 機能・制御
+    "tool_call": ("<|tool_call|>", "<|/tool_call|>"),
+    "function": ("<|function|>", "<|/function|>"),
+    "api": ("<|api|>", "<|/api|>"),
+    "search": ("<|search|>", "<|/search|>"),
+    "knowledge": ("<|knowledge|>", "<|/knowledge|>"),
+    "context": ("<|context|>", "<|/context|>"),
+
+    # 思考・推論
+    "thinking": ("<|thinking|>", "</thinking>"),
+    "reasoning": ("<|reasoning|>", "<|/reasoning|>"),
+    "scratchpad": ("<|scratchpad|>", "<|/scratchpad|>"),
+    "analysis": ("<|analysis|>", "<|/analysis|>"),
+    "summary": ("<|summary|>", "<|/summary|>"),
+    "explanation": ("<|explanation|>", "<|/explanation|>")
+})
+
+# 単体トークン（存在する場合のみ）
+_SINGLE_TOKENS = MappingProxyType({
+    # Fill-in-the-Middle
+    "fim_prefix": "<|fim_prefix|>",
+    "fim_middle": "<|fim_middle|>", 
+    "fim_suffix": "<|fim_suffix|>",
+
+    # リスト・構造
+    "list_item": "<|list_item|>",
+
+    # メディア単体
+    "vision": "<|vision|>",
+
+    # 一般的なマークダウン風
+    "code_inline": "`",
+    "code_block_start": "```",
+    "code_block_end": "```"
+})
+
+# 一括でIDを取得するための候補トークン列（ペア→単体の順）
+_ALL_CANDIDATE_STRS = (
+    tuple(token for pair in _PAIR_TOKENS.values() for token in pair)
+    + tuple(_SINGLE_TOKENS.values())
+)
+
+
+def _get_cached(cache, tokenizer, compute):
+    """tokenizerごとにcomputeの結果をキャッシュして返す（weakref非対応ならキャッシュしない）"""
+    try:
+        cached = cache.get(tokenizer)
+    except TypeError:
+        return compute(tokenizer)
+
+    if cached is None:
+        cached = cache[tokenizer] = compute(tokenizer)
+    return cached
+
+
+def get_end_token_ids(tokenizer) -> frozenset:
+    """
+    tokenizerから終了トークンのID集合を取得する
+
+    Args:
+        tokenizer: tokenizerオブジェクト
+
+    Returns:
+        frozenset: 終了トークンIDの集合
+    """
+    # special_tokens_mapとadded_tokens_encoderから終了トークンを取得
+    end_token_ids: set = set()
+
+    # special_tokens_mapから標準的な終了トークンを取得
+    if hasattr(tokenizer, 'special_tokens_map') and hasattr(tokenizer, 'added_tokens_encoder'):
+        special_map = tokenizer.special_tokens_map
+        added_encoder = tokenizer.added_tokens_encoder
+
+        # EOSトークン
+        eos_token_str = special_map.get('eos_token')
+        if eos_token_str and eos_token_str in added_encoder:
+            end_token_ids.add(added_encoder[eos_token_str])
+
+        # その他の終了関連トークン
+        for key in _END_RELATED_KEYS:
+            token_str = special_map.get(key)
+            if token_str and token_str in added_encoder:
+                end_token_ids.add(added_encoder[token_str])
+
+    # added_tokens_encoderから直接取得（会話終了トークンなど）
+    if hasattr(tokenizer, 'added_tokens_encoder'):
+        added_encoder = tokenizer.added_tokens_encoder
+        for token_str in _CONVERSATION_END_TOKENS:
+            token_id = added_encoder.get(token_str)
+            if token_id is not None:
+                end_token_ids.add(token_id)
+
+    # フォールバック: 直接属性アクセス
+    if hasattr(tokenizer, 'eos_token_id'):
+        end_token_ids.add(tokenizer.eos_token_id)
+
+    return frozenset(end_token_ids)
+
+
+def _get_cached_end_token_ids(tokenizer) -> frozenset:
+    """tokenizerごとにキャッシュした終了トークンIDの集合を返す"""
+    return _get_cached(_END_ID_CACHE, tokenizer, get_end_token_ids)
+
+
+def get_end_token_table(tokenizer, end_token_ids=None) -> bytearray:
+    """
+    トークンIDをインデックスとする終了トークン判定テーブルを作成する
+
+    Args:
+        tokenizer: tokenizerオブジェクト
+        end_token_ids: 終了トークンIDの集合（省略時はtokenizerから取得）
+
+    Returns:
+        bytearray: 終了トークンのIDの位置が1、それ以外が0のテーブル
+    """
+    if end_token_ids is None:
+        end_token_ids = get_end_token_ids(tokenizer)
+
+    ids = [token_id for token_id in end_token_ids if isinstance(token_id, int) and token_id >= 0]
+    size = max([getattr(tokenizer, 'vocab_size', 0) or 0] + [token_id + 1 for token_id in ids])
+
+    table = bytearray(size)
+    for token_id in ids:
+        table[token_id] = 1
+    return table
+
+
+def is_eod_token(response, tokenizer) -> bool:
     """
     レスポンスがEODトークンかどうかを判定する
     
@@ -17,51 +177,13 @@ def is_eod_token(response, tokenizer):
         bool: EODトークンの場合True
     """
     # 1. finish_reasonによる終了判定（MLX-LMの標準的な方法）
-    if hasattr(response, 'finish_reason') and response.finish_reason == 'stop':
+    if getattr(response, 'finish_reason', None) == 'stop':
         return True
     
     # 2. response.tokenによる終了トークン判定
-    if hasattr(response, 'token'):
-        token = response.token
-        
-        # special_tokens_mapとadded_tokens_encoderから終了トークンを取得
-        end_token_ids = []
-        
-        # special_tokens_mapから標準的な終了トークンを取得
-        if hasattr(tokenizer, 'special_tokens_map') and hasattr(tokenizer, 'added_tokens_encoder'):
-            special_map = tokenizer.special_tokens_map
-            added_encoder = tokenizer.added_tokens_encoder
-            
-            # EOSトークン
-            eos_token_str = special_map.get('eos_token')
-            if eos_token_str and eos_token_str in added_encoder:
-                end_token_ids.append(added_encoder[eos_token_str])
-            
-            # その他の終了関連トークン
-            end_related_keys = ['eoi_token']  # end_of_image
-            for key in end_related_keys:
-                token_str = special_map.get(key)
-                if token_str and token_str in added_encoder:
-                    end_token_ids.append(added_encoder[token_str])
-        
-        # added_tokens_encoderから直接取得（会話終了トークンなど）
-        if hasattr(tokenizer, 'added_tokens_encoder'):
-            added_encoder = tokenizer.added_tokens_encoder
-            conversation_end_tokens = ['<end_of_turn>']
-            for token_str in conversation_end_tokens:
-                token_id = added_encoder.get(token_str)
-                if token_id is not None:
-                    end_token_ids.append(token_id)
-        
-        # フォールバック: 直接属性アクセス
-        if hasattr(tokenizer, 'eos_token_id'):
-            end_token_ids.append(tokenizer.eos_token_id)
-        
-        # 重複を除去してチェック
-        if token in set(end_token_ids):
-            return True
-
-    return False
+    # （tokenizerの属性確認はキャッシュ構築時のみ行い、ここでは行わない）
+    token = getattr(response, 'token', None)
+    return token is not None and token in _get_cached_end_token_ids(tokenizer)
 
 
 def get_special_tokens(tokenizer):
@@ -87,83 +209,29 @@ def get_special_tokens(tokenizer):
             if token_id is not None:
                 special_tokens[name] = {"text": token, "id": token_id}
     
-    # ペアトークン（存在する場合のみ）
-    pair_tokens = {
-        # ChatML基本形式
-        "system": ("<|system|>", "<|/system|>"),
-        "user": ("<|user|>", "<|/user|>"),
-        "assistant": ("<|assistant|>", "<|/assistant|>"),
-        
-        # フォーマット・構造化
-        "code": ("<|code_start|>", "<|code_end|>"),
-        "python": ("<|python|>", "<|/python|>"),
-        "javascript": ("<|javascript|>", "<|/javascript|>"),
-        "bash": ("<|bash|>", "<|/bash|>"),
-        "quote": ("<|quote|>", "<|/quote|>"),
-        "ref": ("<|ref|>", "<|/ref|>"),
-        "citation": ("<|citation|>", "<|/citation|>"),
-        "table": ("<|table|>", "<|/table|>"),
-        "heading": ("<|heading|>", "<|/heading|>"),
-        
-        # メディア・リッチコンテンツ
-        "image": ("<|image|>", "<|/image|>"),
-        "audio": ("<|audio|>", "<|/audio|>"),
-        "video": ("<|video|>", "<|/video|>"),
-        
-        # 機能・制御
-        "tool_call": ("<|tool_call|>", "<|/tool_call|>"),
-        "function": ("<|function|>", "<|/function|>"),
-        "api": ("<|api|>", "<|/api|>"),
-        "search": ("<|search|>", "<|/search|>"),
-        "knowledge": ("<|knowledge|>", "<|/knowledge|>"),
-        "context": ("<|context|>", "<|/context|>"),
-        
-        # 思考・推論
-        "thinking": ("<|thinking|>", "</thinking>"),
-        "reasoning": ("<|reasoning|>", "<|/reasoning|>"),
-        "scratchpad": ("<|scratchpad|>", "<|/scratchpad|>"),
-        "analysis": ("<|analysis|>", "<|/analysis|>"),
-        "summary": ("<|summary|>", "<|/summary|>"),
-        "explanation": ("<|explanation|>", "<|/explanation|>")
-    }
-    
-    # 単体トークン（存在する場合のみ）
-    single_tokens = {
-        # Fill-in-the-Middle
-        "fim_prefix": "<|fim_prefix|>",
-        "fim_middle": "<|fim_middle|>", 
-        "fim_suffix": "<|fim_suffix|>",
-        
-        # リスト・構造
-        "list_item": "<|list_item|>",
-        
-        # メディア単体
-        "vision": "<|vision|>",
-        
-        # 一般的なマークダウン風
-        "code_inline": "`",
-        "code_block_start": "```",
-        "code_block_end": "```"
-    }
+    # 候補トークンのIDは1回の呼び出しでまとめて取得する（ペア→単体の順）
+    # get_vocab()は呼び出しごとに語彙全体の辞書を構築するため、数十件の検索には使わない
+    token_ids = iter(tokenizer.convert_tokens_to_ids(list(_ALL_CANDIDATE_STRS)))
+    unk_id = tokenizer.unk_token_id
     
     # ペアトークンの処理
-    for name, (start_token, end_token) in pair_tokens.items():
-        start_id = tokenizer.convert_tokens_to_ids(start_token)
-        end_id = tokenizer.convert_tokens_to_ids(end_token)
+    for name, (start_token, end_token) in _PAIR_TOKENS.items():
+        start_id = next(token_ids)
+        end_id = next(token_ids)
         
         # unk_tokenでない場合のみ追加
-        if start_id != tokenizer.unk_token_id and end_id != tokenizer.unk_token_id:
+        if start_id != unk_id and end_id != unk_id:
             special_tokens[name] = {
                 "start": {"text": start_token, "id": start_id},
                 "end": {"text": end_token, "id": end_id}
             }
     
     # 単体トークンの処理
-    for name, token_text in single_tokens.items():
-        token_id = tokenizer.convert_tokens_to_ids(token_text)
+    for name, token_text in _SINGLE_TOKENS.items():
+        token_id = next(token_ids)
         
         # unk_tokenでない場合のみ追加
-        if token_id != tokenizer.unk_token_id:
+        if token_id != unk_id:
             special_tokens[name] = {"text": token_text, "id": token_id}
     
     return special_tokens